@@ -27,6 +27,7 @@ from ctypes import util
 import math
 import weakref
 import logging
+import types
 
 from cil.utilities.multiprocessing import NUM_THREADS
 # check for the extension
@@ -226,6 +227,21 @@ class Partitioner(object):
         
         return self._partition_deterministic(num_batches, stagger=False, indices=indices)
 
+def _fill_random_sample(array, chunk_size=2**20):
+    """fills array with numpy.random.random_sample values without a full size float64 temporary
+
+    The values are drawn sequentially from the global numpy random state in chunks of 
+    ``chunk_size`` elements, so they are identical to ``random_sample(array.shape)``.
+    """
+    # copyto casts with same_kind like DataContainer.fill, so integer arrays raise a TypeError
+    if not array.flags.c_contiguous:
+        numpy.copyto(array, numpy.random.random_sample(array.shape))
+        return
+
+    flat = array.reshape(-1)
+    for i in range(0, flat.size, chunk_size):
+        numpy.copyto(flat[i:i+chunk_size], numpy.random.random_sample(min(chunk_size, flat.size - i)))
+
 def find_key(dic, val):
     """return the key of dictionary dic given the value"""
     return [k for k, v in dic.items() if v == val][0]
@@ -494,8 +510,8 @@ class ImageGeometry(object):
                 if numpy.iscomplexobj(out.array):
                     r = numpy.random.random_sample(self.shape) + 1j * numpy.random.random_sample(self.shape)
                     out.fill(r)
-                else: 
-                    out.fill(numpy.random.random_sample(self.shape))
+                else:
+                    _fill_random_sample(out.array)
             elif value == ImageGeometry.RANDOM_INT:
                 seed = kwargs.get('seed', None)
                 if seed is not None:
@@ -2602,7 +2618,7 @@ class AcquisitionGeometry(object):
                     r = numpy.random.random_sample(self.shape) + 1j * numpy.random.random_sample(self.shape)
                     out.fill(r)
                 else:
-                    out.fill(numpy.random.random_sample(self.shape))
+                    _fill_random_sample(out.array)
             elif value == AcquisitionGeometry.RANDOM_INT:
                 seed = kwargs.get('seed', None)
                 if seed is not None:
@@ -3708,10 +3724,22 @@ class Processor(object):
                 self.process(out=out)
 
             if self.store_output: 
-                self.output = out.copy()
+                stored = self.output
+                if isinstance(out, DataContainer) and isinstance(stored, DataContainer) and \
+                    stored.shape == out.shape and stored.dtype == out.dtype and \
+                    stored.dimension_labels == out.dimension_labels and stored.geometry == out.geometry:
+                    # reuse the memory of the stored copy
+                    stored.fill(out)
+                    self.__dict__['shouldRun'] = False
+                else:
+                    self.output = out.copy()
             
             return out
 
+        elif out is not None:
+            out.fill(self.output)
+            return out
+
         else:
             return self.output.copy()
             
@@ -3800,14 +3828,22 @@ class AX(DataProcessor):
     def process(self, out=None):
         
         dsi = self.get_input()
+        arr = dsi.as_array()
         a = self.scalar
+        # keep floating point data in its own precision, e.g. float32 * numpy.float64
+        if numpy.issubdtype(arr.dtype, numpy.floating) and numpy.isrealobj(a):
+            a = arr.dtype.type(a)
         if out is None:
-            y = DataContainer( a * dsi.as_array() , True, 
+            y = DataContainer( numpy.multiply(arr, a) , False, 
                         dimension_labels=dsi.dimension_labels )
             #self.setParameter(output_dataset=y)
             return y
         else:
-            out.fill(a * dsi.as_array())
+            if out.shape != arr.shape:
+                raise ValueError('Cannot fill with the provided array.' + \
+                                 'Expecting shape {0} got {1}'.format(
+                                 out.shape, arr.shape))
+            numpy.multiply(arr, a, out=out.as_array())
     
 
 ###### Example of DataProcessors
@@ -3855,11 +3891,26 @@ class PixelByPixelDataProcessor(DataProcessor):
     f is a python function
 
     x a DataSet.
+
+    Parameters
+    ----------
+    compile : bool, default False
+        If True the function is compiled with numba to a ufunc the first time it is applied,
+        and the output has the numeric type numba infers. By default, or if it cannot be
+        compiled, the function is evaluated in python for each pixel.
+
+    Note
+    ----
+    A compiled function does not behave exactly as the python function: the globals and
+    closure variables it reads are frozen at their values when it is compiled, and integer
+    results have a fixed width and wrap around on overflow.
     '''
     
-    def __init__(self):
+    def __init__(self, compile=False):
         kwargs = {'pyfunc':None, 
                   'input':None, 
+                  'compile':compile,
+                  '_vectorised':None
                   }
         #DataProcessor.__init__(self, **kwargs)
         super(PixelByPixelDataProcessor, self).__init__(**kwargs)
@@ -3872,13 +3923,38 @@ class PixelByPixelDataProcessor(DataProcessor):
         pyfunc = self.pyfunc
         dsi = self.get_input()
         
-        eval_func = numpy.frompyfunc(pyfunc,1,1)
+        arr = None
+        if self.compile:
+            # compile once per pyfunc, set directly so the processor is not flagged to rerun
+            if self._vectorised is None or self._vectorised[0] is not pyfunc:
+                self.__dict__['_vectorised'] = (pyfunc, self._vectorise(pyfunc))
 
-        
-        y = DataContainer( eval_func( dsi.as_array() ) , True, 
+            if self._vectorised[1] is not None:
+                try:
+                    arr = self._vectorised[1](dsi.as_array())
+                except Exception:
+                    # not supported by numba for this input, do not try again
+                    self.__dict__['_vectorised'] = (pyfunc, None)
+
+        if arr is None:
+            eval_func = numpy.frompyfunc(pyfunc,1,1)
+            arr = eval_func( dsi.as_array() )
+
+        y = DataContainer( arr , False, 
                     dimension_labels=dsi.dimension_labels )
         return y
     
+    @staticmethod
+    def _vectorise(pyfunc):
+        '''Returns pyfunc compiled to a ufunc with numba, or None if it is not a python function or cannot be compiled'''
+        if not isinstance(pyfunc, types.FunctionType):
+            return None
+        try:
+            import numba
+            return numba.vectorize(pyfunc)
+        except Exception:
+            return None
+
 
 class VectorData(DataContainer):
     '''DataContainer to contain 1D array'''
@@ -4005,7 +4081,7 @@ class VectorGeometry(object):
                 seed = kwargs.get('seed', None)
                 if seed is not None:
                     numpy.random.seed(seed) 
-                out.fill(numpy.random.random_sample(self.shape))
+                _fill_random_sample(out.array)
             elif value == VectorGeometry.RANDOM_INT:
                 seed = kwargs.get('seed', None)
                 if seed is not None:
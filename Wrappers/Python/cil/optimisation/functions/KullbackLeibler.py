@@ -90,6 +90,9 @@ class KullbackLeibler(Function):
 
     def __new__(cls, b, eta = None, mask = None, backend = 'numba'):
 
+        if backend not in ['numba', 'numpy']:
+            raise ValueError("backend should be 'numba' or 'numpy', got {}".format(backend))
+
         # default backend numba
         cls.backend = backend
         
@@ -109,23 +112,77 @@ class KullbackLeibler(Function):
         self.b = b
         self.eta = eta
         self.mask = mask
+        self._scratch = None
 
+        # without background noise the numpy methods skip the terms in eta
+        self._eta_is_zero = self.eta is None
         if self.eta is None:
             self.eta = self.b * 0.0
 
-        if numpy.any(self.b.as_array() < 0):            
+        if self.b.min() < 0:
             raise ValueError("Input data should be non-negative.")         
 
-        if KullbackLeibler.backend == 'numba':
+        # cached for the methods working on the arrays directly,
+        # the numba kernels index with .flat, which is only cheap on C-contiguous arrays
+        self.b_np = numpy.ascontiguousarray(self.b.as_array())
+        self.eta_np = numpy.ascontiguousarray(self.eta.as_array())
 
-            self.b_np = self.b.as_array()
-            self.eta_np = self.eta.as_array()
+        if KullbackLeibler.backend == 'numba':
 
             if mask is not None:
-                self.mask = mask.as_array()
+                self.mask = numpy.ascontiguousarray(mask.as_array())
                         
         super(KullbackLeibler, self).__init__(L = None) 
 
+    @staticmethod
+    def batch_call(b, x, eta = None):
+
+        r"""Returns the values of the KullbackLeibler function for a batch of problems stacked along the first axis.
+
+        Each entry :math:`k` of the result is the KullbackLeibler function at :math:`(b_{k}, x_{k} + \eta_{k})`,
+        evaluated as in the numpy backend. The whole batch is computed in one vectorised pass.
+
+        Parameters
+        ----------
+        b : DataContainer or numpy.ndarray, non-negative
+            Data of each problem, stacked along the first axis.
+        x : DataContainer or numpy.ndarray
+            Points where the functions are evaluated, same shape as `b`.
+        eta : DataContainer or numpy.ndarray, default = None
+            Background noise, same shape as `b`.
+
+        Returns
+        -------
+        numpy.ndarray
+            The values of the functions, one per problem.
+
+        Note
+        ----
+        To avoid infinity values, we consider only pixels/voxels for :math:`x+\eta\geq0`.
+        """
+
+        b = b.as_array() if hasattr(b, 'as_array') else numpy.asarray(b)
+        x = x.as_array() if hasattr(x, 'as_array') else numpy.asarray(x)
+
+        if eta is None:
+            tmp_sum = x
+        else:
+            tmp_sum = x + (eta.as_array() if hasattr(eta, 'as_array') else numpy.asarray(eta))
+
+        tmp = scipy.special.kl_div(b, tmp_sum)
+        tmp = numpy.where(tmp_sum >= 0, tmp, 0)
+        return tmp.reshape(tmp.shape[0], -1).sum(axis=1)
+
+    def _allocate_like(self, x, value=None):
+
+        r"""Returns a new container with the geometry and type of `x` without evaluating `x * 0`.
+        
+        If `value` is None the memory is left uninitialised, so the caller must overwrite every element."""
+
+        if x.geometry is None:
+            return x * 0
+        return x.geometry.allocate(value, dtype=x.dtype)
+
 class KullbackLeibler_numpy(KullbackLeibler):
        
     def __call__(self, x):
@@ -137,10 +194,16 @@ class KullbackLeibler_numpy(KullbackLeibler):
         To avoid infinity values, we consider only pixels/voxels for :math:`x+\eta\geq0`.
         """
 
-        tmp_sum = (x + self.eta).as_array()
-        ind = tmp_sum >= 0
-        tmp = scipy.special.kl_div(self.b.as_array()[ind], tmp_sum[ind])             
-        return numpy.sum(tmp) 
+        tmp = self._get_scratch(x).as_array()
+        if self._eta_is_zero:
+            ind = x.as_array() >= 0
+            scipy.special.kl_div(self.b_np, x.as_array(), out=tmp)
+        else:
+            numpy.add(x.as_array(), self.eta_np, out=tmp)
+            ind = tmp >= 0
+            # kl_div returns inf where x + eta < 0, these are masked out in the reduction
+            scipy.special.kl_div(self.b_np, tmp, out=tmp)
+        return numpy.sum(tmp, where=ind)
 
     def gradient(self, x, out = None):
 
@@ -156,14 +219,17 @@ class KullbackLeibler_numpy(KullbackLeibler):
 
         should_return=False
         if out is None:
-            out = x.add(self.eta)
+            out = x.copy() if self._eta_is_zero else x.add(self.eta)
             should_return=True
+        elif self._eta_is_zero:
+            out.fill(x)
         else:
             x.add(self.eta,out=out)
 
         arr = out.as_array()
-        arr[arr>0] = 1 - self.b.as_array()[arr>0]/arr[arr>0]
-
+        ind = arr > 0
+        numpy.divide(self.b_np, arr, out=arr, where=ind)
+        numpy.subtract(1, arr, out=arr, where=ind)
         out.fill(arr)
 
         if should_return:
@@ -177,10 +243,14 @@ class KullbackLeibler_numpy(KullbackLeibler):
         
         """          
 
-        tmp = 1 - x.as_array()
-        ind = tmp>0
-        xlogy = - scipy.special.xlogy(self.b.as_array()[ind], tmp[ind])
-        return numpy.sum(xlogy) - self.eta.dot(x)
+        tmp = self._get_scratch(x).as_array()
+        numpy.subtract(1, x.as_array(), out=tmp)
+        ind = tmp > 0
+        # xlogy is nan where 1 - x <= 0, these are masked out in the reduction
+        scipy.special.xlogy(self.b_np, tmp, out=tmp)
+        if self._eta_is_zero:
+            return - numpy.sum(tmp, where=ind)
+        return - numpy.sum(tmp, where=ind) - self.eta.dot(x)
 
     def proximal(self, x, tau, out = None):
 
@@ -190,20 +260,38 @@ class KullbackLeibler_numpy(KullbackLeibler):
                             
         """        
         
-        if out is None:        
-            return 0.5 *( (x - self.eta - tau) + \
-                ( (x + self.eta - tau).power(2) + 4*tau*self.b   ) .sqrt() \
-                    )        
-        else:                      
-            x.add(self.eta, out=out)
-            out -= tau
-            out *= out
-            out.add(self.b * (4 * tau), out=out)
-            out.sqrt(out=out)  
-            out.subtract(tau, out=out)
-            out.subtract(self.eta, out=out)
-            out.add(x, out=out)         
-            out *= 0.5             
+        should_return = False
+        if out is None:
+            out = self._allocate_like(x)
+            should_return = True
+
+        tmp = self._get_scratch(x)
+        x_np, out_np, tmp_np = x.as_array(), out.as_array(), tmp.as_array()
+        tau_np = tau if isinstance(tau, Number) else tau.as_array()
+
+        # as_array may return a copy of the data, so the containers are filled
+        # before and the arrays fetched again after each sapyb
+        # tmp = x - eta - tau, out = x + eta - tau = tmp + 2 * eta
+        if self._eta_is_zero:
+            numpy.subtract(x_np, tau_np, out=tmp_np)
+            numpy.multiply(tmp_np, tmp_np, out=out_np)
+        else:
+            numpy.subtract(x_np, self.eta_np, out=tmp_np)
+            tmp_np -= tau_np
+            tmp.fill(tmp_np)
+            tmp.sapyb(1, self.eta, 2, out=out)
+            out_np = out.as_array()
+            out_np *= out_np
+        out.fill(out_np)
+        out.sapyb(1, self.b, 4 * tau, out=out)
+        out_np = out.as_array()
+        numpy.sqrt(out_np, out=out_np)
+        out_np += tmp_np
+        out_np *= 0.5
+        out.fill(out_np)
+
+        if should_return:
+            return out
 
 
     def proximal_conjugate(self, x, tau, out = None):
@@ -211,24 +299,64 @@ class KullbackLeibler_numpy(KullbackLeibler):
         r"""Returns the value of the proximal operator of the convex conjugate of KullbackLeibler at :math:`(b, x + \eta)`.
            
         :math:`\mathrm{prox}_{\tau F^{*}}(x) = 0.5*((z + 1) - \sqrt{(z-1)^2 + 4 * \tau b})`, where :math:`z = x + \tau \eta`.
+
+        Note
+        ----
+        Where :math:`z + 1 \geq 0` this is evaluated as :math:`\frac{2(z - \tau b)}{(z + 1) + \sqrt{(z-1)^2 + 4 * \tau b}}`,
+        which is equivalent and avoids the loss of precision in the difference when :math:`\tau b` is close to :math:`z`.
+        Where :math:`z + 1 < 0` the original form is used, as the rationalised denominator would cancel instead.
         """        
         
+        should_return = False
         if out is None:
-            z = x + tau * self.eta
-            return 0.5*((z + 1) - ((z-1).power(2) + 4 * tau * self.b).sqrt())
-        else:            
-            tmp = tau * self.eta
-            tmp += x
-            tmp -= 1
-            
-            self.b.multiply(4*tau, out=out)    
-            
-            out.add(tmp.power(2), out=out)
-            out.sqrt(out=out)
-            out *= -1
-            tmp += 2
-            out += tmp
-            out *= 0.5
+            out = self._allocate_like(x)
+            should_return = True
+
+        tmp = self._get_scratch(x)
+        x_np, out_np, tmp_np = x.as_array(), out.as_array(), tmp.as_array()
+        tau_np = tau if isinstance(tau, Number) else tau.as_array()
+
+        # as_array may return a copy of the data, so the containers are filled
+        # before and the arrays fetched again after each sapyb
+        # tmp = z, kept exact as both (z-1)^2 and the numerator z - tau * b are formed from it
+        if self._eta_is_zero:
+            numpy.copyto(tmp_np, x_np)
+        else:
+            numpy.multiply(self.eta_np, tau_np, out=tmp_np)
+            tmp_np += x_np
+
+        numpy.subtract(tmp_np, 1, out=out_np)
+        out_np *= out_np
+        out.fill(out_np)
+        out.sapyb(1, self.b, 4 * tau, out=out)
+        out_np = out.as_array()
+        numpy.sqrt(out_np, out=out_np)
+
+        # for z + 1 >= 0 the rationalised form 2 * (z - tau * b) / ((z + 1) + sqrt((z-1)^2 + 4 * tau * b))
+        # avoids the cancellation between z + 1 and the square root, otherwise
+        # the original form has no cancellation and the rationalised one does
+        pos = tmp_np >= -1
+        neg = ~pos
+        numpy.add(out_np, tmp_np, out=out_np, where=pos)
+        numpy.subtract(tmp_np, out_np, out=out_np, where=neg)
+        out_np += 1
+        tmp.fill(tmp_np)
+        tmp.sapyb(2, self.b, -2 * tau, out=tmp)
+        tmp_np = tmp.as_array()
+        numpy.divide(tmp_np, out_np, out=out_np, where=pos)
+        numpy.multiply(out_np, 0.5, out=out_np, where=neg)
+        out.fill(out_np)
+
+        if should_return:
+            return out
+
+    def _get_scratch(self, x):
+
+        r"""Returns a work container with the shape and type of `x`, allocated once and reused between calls."""
+
+        if self._scratch is None or self._scratch.shape != x.shape or self._scratch.dtype != x.dtype:
+            self._scratch = self._allocate_like(x)
+        return self._scratch
 
 ####################################
 ## KullbackLeibler numba routines ##
@@ -289,45 +417,65 @@ if has_numba:
     def kl_proximal_conjugate_arr(x, b, eta, tau, out):
         #z = x + tau * self.bnoise
         #return 0.5*((z + 1) - ((z-1)**2 + 4 * tau * self.b).sqrt())
+        # for z + 1 >= 0 evaluated in the equivalent rationalised form, which
+        # avoids the cancellation between z + 1 and the square root there
+        #return 2*(z - tau * self.b) / ((z + 1) + ((z-1)**2 + 4 * tau * self.b).sqrt())
         for i in prange(x.size):
             t = tau.flat[i]
             z = x.flat[i] + ( t * eta.flat[i] )
-            out.flat[i] = 0.5 * ( 
-                (z + 1) - numpy.sqrt((z-1)*(z-1) + 4 * t * b.flat[i])
-                )
+            B = t * b.flat[i]
+            if z + 1 >= 0:
+                out.flat[i] = 2 * (z - B) / ((z + 1) + numpy.sqrt((z-1)*(z-1) + 4 * B))
+            else:
+                out.flat[i] = 0.5 * ((z + 1) - numpy.sqrt((z-1)*(z-1) + 4 * B))
         
     @jit(parallel=True, nopython=True)
     def kl_proximal_conjugate(x, b, eta, tau, out):
         #z = x + tau * self.bnoise
         #return 0.5*((z + 1) - ((z-1)**2 + 4 * tau * self.b).sqrt())
+        # for z + 1 >= 0 evaluated in the equivalent rationalised form, which
+        # avoids the cancellation between z + 1 and the square root there
+        #return 2*(z - tau * self.b) / ((z + 1) + ((z-1)**2 + 4 * tau * self.b).sqrt())
         for i in prange(x.size):
             z = x.flat[i] + ( tau * eta.flat[i] )
-            out.flat[i] = 0.5 * ( 
-                (z + 1) - numpy.sqrt((z-1)*(z-1) + 4 * tau * b.flat[i])
-                )
+            B = tau * b.flat[i]
+            if z + 1 >= 0:
+                out.flat[i] = 2 * (z - B) / ((z + 1) + numpy.sqrt((z-1)*(z-1) + 4 * B))
+            else:
+                out.flat[i] = 0.5 * ((z + 1) - numpy.sqrt((z-1)*(z-1) + 4 * B))
 
     @jit(parallel=True, nopython=True)
     def kl_proximal_conjugate_arr_mask(x, b, eta, tau, out, mask):
         #z = x + tau * self.bnoise
         #return 0.5*((z + 1) - ((z-1)**2 + 4 * tau * self.b).sqrt())
+        # for z + 1 >= 0 evaluated in the equivalent rationalised form, which
+        # avoids the cancellation between z + 1 and the square root there
+        #return 2*(z - tau * self.b) / ((z + 1) + ((z-1)**2 + 4 * tau * self.b).sqrt())
         for i in prange(x.size):
             if mask.flat[i] > 0:
                 t = tau.flat[i]
                 z = x.flat[i] + ( t * eta.flat[i] )
-                out.flat[i] = 0.5 * ( 
-                    (z + 1) - numpy.sqrt((z-1)*(z-1) + 4 * t * b.flat[i])
-                    )
+                B = t * b.flat[i]
+                if z + 1 >= 0:
+                    out.flat[i] = 2 * (z - B) / ((z + 1) + numpy.sqrt((z-1)*(z-1) + 4 * B))
+                else:
+                    out.flat[i] = 0.5 * ((z + 1) - numpy.sqrt((z-1)*(z-1) + 4 * B))
         
     @jit(parallel=True, nopython=True)
     def kl_proximal_conjugate_mask(x, b, eta, tau, out, mask):
         #z = x + tau * self.bnoise
         #return 0.5*((z + 1) - ((z-1)**2 + 4 * tau * self.b).sqrt())
+        # for z + 1 >= 0 evaluated in the equivalent rationalised form, which
+        # avoids the cancellation between z + 1 and the square root there
+        #return 2*(z - tau * self.b) / ((z + 1) + ((z-1)**2 + 4 * tau * self.b).sqrt())
         for i in prange(x.size):
             if mask.flat[i] > 0:
                 z = x.flat[i] + ( tau * eta.flat[i] )
-                out.flat[i] = 0.5 * ( 
-                    (z + 1) - numpy.sqrt((z-1)*(z-1) + 4 * tau * b.flat[i])
-                    )
+                B = tau * b.flat[i]
+                if z + 1 >= 0:
+                    out.flat[i] = 2 * (z - B) / ((z + 1) + numpy.sqrt((z-1)*(z-1) + 4 * B))
+                else:
+                    out.flat[i] = 0.5 * ((z + 1) - numpy.sqrt((z-1)*(z-1) + 4 * B))
     # gradient
     @jit(parallel=True, nopython=True)
     def kl_gradient(x, b, out, eta):
@@ -340,6 +488,9 @@ if has_numba:
                 out.flat[i] = 1 - b.flat[i]/(x.flat[i] + eta.flat[i])
     
     # KL divergence
+    # Note: an early return from inside prange prevents numba from 
+    # parallelising the loop, so infeasible points add inf to the 
+    # accumulator instead and the reduction runs in a single parallel pass.
     @jit(parallel=True, nopython=True)
     def kl_div(x, y, eta):
         accumulator = 0.
@@ -354,7 +505,7 @@ if has_numba:
                 accumulator += Y
             else:
                 # out.flat[i] = numpy.inf
-                return numpy.inf
+                accumulator += numpy.inf
         return accumulator
     @jit(parallel=True, nopython=True)
     def kl_div_mask(x, y, eta, mask):
@@ -371,7 +522,7 @@ if has_numba:
                     accumulator += Y
                 else:
                     # out.flat[i] = numpy.inf
-                    return numpy.inf
+                    accumulator += numpy.inf
         return accumulator
 
     # convex conjugate
@@ -448,14 +599,15 @@ class KullbackLeibler_numba(KullbackLeibler):
 
         should_return = False
         if out is None:
-            out = x * 0 
+            out = self._allocate_like(x, None if self.mask is None else 0)
             should_return = True
 
         out_np = out.as_array() 
 
         if self.mask is not None:
-            kl_gradient_mask(x.as_array(), self.b.as_array(), out_np, self.eta.as_array(), self.mask)         
-        kl_gradient(x.as_array(), self.b.as_array(), out_np, self.eta.as_array())            
+            kl_gradient_mask(x.as_array(), self.b_np, out_np, self.eta_np, self.mask)         
+        else:
+            kl_gradient(x.as_array(), self.b_np, out_np, self.eta_np)            
         out.fill(out_np)
 
         if should_return:
@@ -471,7 +623,7 @@ class KullbackLeibler_numba(KullbackLeibler):
 
         should_return = False
         if out is None:
-            out = x * 0 
+            out = self._allocate_like(x, None if self.mask is None else 0)
             should_return = True
 
         out_np = out.as_array() 
@@ -486,7 +638,7 @@ class KullbackLeibler_numba(KullbackLeibler):
             # it should be a DataContainer
             if self.mask is not None:
                 kl_proximal_arr_mask(x.as_array(), self.b_np, tau.as_array(), \
-                    out_np, self.eta_np)
+                    out_np, self.eta_np, self.mask)
             else:
                 kl_proximal_arr(x.as_array(), self.b_np, tau.as_array(), \
                     out_np, self.eta_np)  
@@ -501,11 +653,17 @@ class KullbackLeibler_numba(KullbackLeibler):
         r"""Returns the value of the proximal operator of the convex conjugate of KullbackLeibler at :math:`(b, x + \eta)`.
            
         :math:`\mathrm{prox}_{\tau F^{*}}(x) = 0.5*((z + 1) - \sqrt{(z-1)^2 + 4 * \tau b})`, where :math:`z = x + \tau \eta`.
+
+        Note
+        ----
+        Where :math:`z + 1 \geq 0` this is evaluated as :math:`\frac{2(z - \tau b)}{(z + 1) + \sqrt{(z-1)^2 + 4 * \tau b}}`,
+        which is equivalent and avoids the loss of precision in the difference when :math:`\tau b` is close to :math:`z`.
+        Where :math:`z + 1 < 0` the original form is used, as the rationalised denominator would cancel instead.
         """        
 
         should_return = False
         if out is None:
-            out = x * 0 
+            out = self._allocate_like(x, None if self.mask is None else 0)
             should_return = True
 
         out_np = out.as_array()              
@@ -21,6 +21,7 @@
 from cil.framework import DataProcessor, AcquisitionData, ImageData, DataContainer, AcquisitionGeometry, ImageGeometry
 import warnings
 import numpy
+import numba
 
 
 class AbsorptionTransmissionConverter(DataProcessor):
@@ -29,17 +30,21 @@ class AbsorptionTransmissionConverter(DataProcessor):
     
     :param white_level: A float defining incidence intensity in the Beer-Lambert law.
     :type white_level: float, optional
+    :param dtype: Numerical type of the output, default None keeps the type of floating point input and uses a floating point type for integer input. Use numpy.float32 to halve the output size for float64 data.
+    :type dtype: numpy type, optional
     :return: returns AcquisitionData, ImageData or DataContainer depending on input data type
     :rtype: AcquisitionData, ImageData or DataContainer
 
-    Processor first multiplies data by -1, then calculates exponent 
-    and scales result by white_level (default=1)
+    Processor calculates the exponent of the data multiplied by -1
+    and scales result by white_level (default=1), in a single pass
     '''
 
     def __init__(self,
-                 white_level=1):
+                 white_level=1,
+                 dtype=None):
 
-        kwargs = {'white_level': white_level}
+        kwargs = {'white_level': white_level,
+                  'dtype': dtype}
 
         super(AbsorptionTransmissionConverter, self).__init__(**kwargs)
 
@@ -55,10 +60,25 @@ class AbsorptionTransmissionConverter(DataProcessor):
 
         data = self.get_input()
         if out is None:
-            out = data.multiply(-1.0)          
-        else:
-            data.multiply(-1.0, out=out)
+            dtype = numpy.result_type(data.dtype, numpy.float32) if self.dtype is None else self.dtype
+            if data.geometry is None:
+                out = DataContainer(numpy.empty(data.shape, dtype=dtype), deep_copy=False,
+                                    dimension_labels=data.dimension_labels)
+            else:
+                out = data.geometry.allocate(None, dtype=dtype)
 
-        out.exp(out=out)
-        out.multiply(numpy.float32(self.white_level), out=out)
-        return out
\ No newline at end of file
+        _absorption_to_transmission(data.as_array(), float(self.white_level), out.as_array())
+        return out
+
+
+@numba.jit(nopython=True, parallel=True, nogil=True)
+def _absorption_to_transmission(x, white_level, out):
+    '''Computes out = white_level * exp(-x), out can be x
+    
+    Releases the GIL, so several slabs can be processed concurrently from Python threads'''
+    if white_level == 1:
+        for i in numba.prange(x.size):
+            out.flat[i] = numpy.exp(-x.flat[i])
+    else:
+        for i in numba.prange(x.size):
+            out.flat[i] = white_level * numpy.exp(-x.flat[i])
@@ -19,12 +19,14 @@
 
 from cil.processors import Slicer
 import numpy as np
+import numba
 
-try:
+from cil.framework import cilacc
+
+# the library may be built without IPP, in which case it has no binner
+has_ipp = hasattr(cilacc, 'Binner_new')
+if has_ipp:
     from cil.processors.cilacc_binner import Binner_IPP
-    has_ipp = True
-except:
-    has_ipp = False
 
 # Note to developers: Binner and Slicer share a lot of common code
 # so Binner has been implemented as a child of Slicer. This makes use
@@ -51,6 +53,7 @@ class Binner(Slicer):
 
     accelerated : boolean, default=True
         Uses the CIL accelerated backend if `True`, numpy if `False`.
+        If the IPP libraries are not available the accelerated backend is a numba kernel.
 
 
     Example
@@ -92,11 +95,8 @@ class Binner(Slicer):
     def __init__(self,
                  roi = None, accelerated=True):
 
-        if accelerated and not has_ipp:
-            raise RuntimeError("Cannot run accelerated Binner without the IPP libraries.")
-
         super(Binner,self).__init__(roi = roi)
-        self._accelerated = True
+        self._accelerated = accelerated
 
 
     def _configure(self):
@@ -143,7 +143,6 @@ class Binner(Slicer):
         Bins the array using numpy. This method is slower and less memory efficient than self._bin_array_acc
         """
         shape_object = []
-        slice_object = []
 
         for i in range(4):
             # reshape the data to add each 'bin' dimensions
@@ -155,11 +154,8 @@ class Binner(Slicer):
       
         data_resized = array_in.reshape(self._shape_in)[slice_object].reshape(shape_object)
 
-        mean_order = (-1, 1, 2, 3)
-        for i in range(4):
-            data_resized = data_resized.mean(mean_order[i])
-            
-        np.copyto(array_binned, data_resized)
+        # average all the bin dimensions in a single reduction, written directly to the output
+        data_resized.mean(axis=(1, 3, 5, 7), out=array_binned.reshape(self._shape_out))
 
 
     def _bin_array_acc(self, array_in, array_binned):
@@ -176,12 +172,55 @@ class Binner(Slicer):
             raise RuntimeError("Call failed")
 
 
+    def _bin_array_numba(self, array_in, array_binned):
+        """
+        Bins the array using numba, reading each input element once
+        """
+        starts = np.array([x.start for x in self._roi_ordered], dtype=np.int64)
+        bins = np.array([x.step for x in self._roi_ordered], dtype=np.int64)
+
+        _bin_array_4D(array_in.reshape(self._shape_in), starts, bins, array_binned.reshape(self._shape_out))
+
+
     def _process_data(self, dc_in, dc_out):
         """
         Bin the data array
         """
         if self._accelerated:
-            self._bin_array_acc(dc_in.array, dc_out.array)
+            if has_ipp:
+                self._bin_array_acc(dc_in.array, dc_out.array)
+            else:
+                self._bin_array_numba(dc_in.array, dc_out.array)
         else:
             self._bin_array_numpy(dc_in.array, dc_out.array)
 
+
+@numba.jit(nopython=True, parallel=True, nogil=True)
+def _bin_array_4D(array_in, starts, bins, array_binned):
+    '''Averages the 4D array_in in bins of size `bins` from index `starts` into array_binned
+    
+    Each output row is accumulated in float64 from contiguous input rows, so every input element is read once'''
+    n0, n1, n2, n3 = array_binned.shape
+    norm = bins[0] * bins[1] * bins[2] * bins[3]
+
+    for k in numba.prange(n0 * n1 * n2):
+        i0 = k // (n1 * n2)
+        i1 = (k // n2) % n1
+        i2 = k % n2
+
+        acc = np.zeros(n3, dtype=np.float64)
+        for d0 in range(bins[0]):
+            for d1 in range(bins[1]):
+                for d2 in range(bins[2]):
+                    row = array_in[starts[0] + i0 * bins[0] + d0, 
+                                   starts[1] + i1 * bins[1] + d1, 
+                                   starts[2] + i2 * bins[2] + d2]
+                    for i3 in range(n3):
+                        j = starts[3] + i3 * bins[3]
+                        for d3 in range(bins[3]):
+                            acc[i3] += row[j + d3]
+
+        for i3 in range(n3):
+            array_binned[i0, i1, i2, i3] = acc[i3] / norm
+
+
@@ -19,6 +19,7 @@
 
 from cil.framework import Processor, AcquisitionData
 import numpy as np
+import scipy.signal
 
 import logging
 
@@ -121,7 +122,7 @@ class CofR_xcorrelation(Processor):
 
     
         border = int(data1.size * 0.05)
-        lag = np.correlate(data1[border:-border],data2[border:-border],"full")
+        lag = scipy.signal.correlate(data1[border:-border],data2[border:-border],"full", method='fft')
 
         ind = lag.argmax()
         
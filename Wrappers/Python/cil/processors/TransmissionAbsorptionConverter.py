@@ -20,6 +20,7 @@
 from cil.framework import DataProcessor, AcquisitionData, ImageData, DataContainer
 import warnings
 import numpy
+import numba
 
 
 class TransmissionAbsorptionConverter(DataProcessor):
@@ -36,6 +37,7 @@ class TransmissionAbsorptionConverter(DataProcessor):
     
     Processor first divides by white_level (default=1) and then take negative logarithm. 
     Elements below threshold (after division by white_level) are set to threshold.
+    All three steps are computed in a single pass over the data.
     '''
 
     def __init__(self,
@@ -66,27 +68,30 @@ class TransmissionAbsorptionConverter(DataProcessor):
 
         return_val = False
         if out is None:
-            out = data.geometry.allocate(None)
+            if data.geometry is None:
+                # float32, as geometry.allocate, raw counts are usually integers
+                out = DataContainer(numpy.empty(data.shape, dtype=numpy.float32), deep_copy=False,
+                                    dimension_labels=data.dimension_labels)
+            else:
+                out = data.geometry.allocate(None)
             return_val = True
 
-        arr_in = data.as_array()
-        arr_out = out.as_array()
+        _transmission_to_absorption(data.as_array(), float(self.white_level), 
+                                    float(self.min_intensity), out.as_array())
 
-        #whitelevel
-        if self.white_level != 1:
-            numpy.divide(arr_in, self.white_level, out=arr_out)
-            arr_in = arr_out
+        if return_val:
+            return out
 
-        #threshold
-        if self.min_intensity > 0:
-            numpy.clip(arr_in, self.min_intensity, None, out=arr_out)
-            arr_in = arr_out
 
-        #beer-lambert
-        numpy.log(arr_in,out=arr_out)
-        numpy.negative(arr_out,out=arr_out)
-        
-        out.fill(arr_out)
+@numba.jit(nopython=True, parallel=True, nogil=True)
+def _transmission_to_absorption(x, white_level, min_intensity, out):
+    '''Computes out = -log(max(x / white_level, min_intensity)), out can be x
 
-        if return_val:
-            return out
+    The threshold is only applied if min_intensity > 0'''
+    for i in numba.prange(x.size):
+        v = x.flat[i]
+        if white_level != 1:
+            v = v / white_level
+        if min_intensity > 0 and v < min_intensity:
+            v = min_intensity
+        out.flat[i] = -numpy.log(v)
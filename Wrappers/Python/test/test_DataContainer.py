@@ -695,6 +695,30 @@ class TestDataContainer(CCPiTestClass):
         numpy.testing.assert_allclose(image1.as_array(), image2.as_array())
 
 
+    def test_allocate_random_matches_random_sample(self):
+        # allocate('random') fills in chunks, the values must match a single random_sample call
+        geometries = [ImageGeometry(voxel_num_x=4, voxel_num_y=3, channels=2), 
+                      AcquisitionGeometry.create_Parallel2D().set_angles([0, 90, 180]).set_panel(5),
+                      VectorGeometry(7)]
+        for geometry in geometries:
+            for dtype in [numpy.float32, numpy.float64]:
+                data = geometry.allocate('random', seed=3, dtype=dtype)
+                numpy.random.seed(3)
+                numpy.testing.assert_array_equal(data.as_array(), 
+                    numpy.random.random_sample(geometry.shape).astype(dtype))
+
+        from cil.framework.framework import _fill_random_sample
+        arr = numpy.empty((5, 7), dtype=numpy.float32)
+        numpy.random.seed(3)
+        _fill_random_sample(arr, chunk_size=4)
+        numpy.random.seed(3)
+        numpy.testing.assert_array_equal(arr, numpy.random.random_sample((5, 7)).astype(numpy.float32))
+
+        # random floats cannot be cast to an integer dtype
+        with self.assertRaises(TypeError):
+            ImageGeometry(3, 2).allocate('random', dtype=numpy.int32)
+
+
     def test_AcquisitionDataSubset(self):
         sgeometry = AcquisitionGeometry.create_Parallel3D().set_angles(numpy.linspace(0, 180, num=10)).set_panel((5,3)).set_channels(2)
 
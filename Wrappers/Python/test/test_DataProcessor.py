@@ -18,6 +18,9 @@
 # CIL Developers, listed at: https://github.com/TomographicImaging/CIL/blob/master/NOTICE.txt
 
 import unittest
+from unittest import mock
+import sys
+import math
 import numpy
 from cil.framework import DataContainer
 from cil.framework import ImageGeometry, VectorGeometry, AcquisitionGeometry
@@ -33,7 +36,7 @@ from cil.processors import TransmissionAbsorptionConverter, AbsorptionTransmissi
 from cil.processors import Slicer, Binner, MaskGenerator, Masker, Padder
 import gc
 
-from utils import has_astra, has_tigre, has_nvidia, has_tomophantom, initialise_tests, has_ipp
+from utils import has_astra, has_tigre, has_nvidia, has_tomophantom, initialise_tests, has_ipp, has_numba
 
 initialise_tests()
 
@@ -92,13 +95,14 @@ class TestBinner_cillacc(unittest.TestCase):
         binner_cpp = Binner_IPP(shape_in,shape_out,start_index,binning)
         binner_cpp.bin(data.array, binned_arr)
 
+        arr = data.array
         k_out=0
         for k in range(start_index[1],start_index[1]+shape_out[1]):
             j_out=0
             for j in range(start_index[2],start_index[2]+shape_out[2]*binning[2], binning[2]):
                 i_out = 0
                 for i in range(start_index[3],start_index[3]+shape_out[3]*binning[3], binning[3]):
-                    binned_by_hand[0,k_out,j_out,i_out]  = data.array[k,j:j+binning[2],i:i+binning[3]].mean()
+                    binned_by_hand[0,k_out,j_out,i_out]  = arr[k,j:j+binning[2],i:i+binning[3]].mean()
                     i_out +=1
                 j_out +=1
             k_out +=1
@@ -404,6 +408,7 @@ class TestBinner(unittest.TestCase):
         binner._bin_array_acc(data.array, binned_arr_acc)
 
 
+        arr = data.array
         l_out = 0
         for l in range(1,shape_binned[0]*2, 2):
             k_out = 0
@@ -412,7 +417,7 @@ class TestBinner(unittest.TestCase):
                 for j in range(1,shape_binned[2]*8, 8):
                     i_out = 0
                     for i in range(1, shape_binned[3]*16, 16):
-                        binned_by_hand[l_out,k_out,j_out,i_out]  = data.array[l:l+2,k:k+4,j:j+8,i:i+16].mean()
+                        binned_by_hand[l_out,k_out,j_out,i_out]  = arr[l:l+2,k:k+4,j:j+8,i:i+16].mean()
                         i_out +=1
                     j_out +=1
                 k_out +=1
@@ -421,6 +426,69 @@ class TestBinner(unittest.TestCase):
         numpy.testing.assert_allclose(binned_by_hand,binned_arr_numpy,atol=1e-6)
         numpy.testing.assert_allclose(binned_by_hand,binned_arr_acc,atol=1e-6)
 
+
+    def test_bin_array_numba(self):
+
+        ig = ImageGeometry(64,32,16,channels=8)
+        data = ig.allocate('random')
+
+        rois = [{'horizontal_x':(1,-1,16),'horizontal_y':(1,-1,8),'channel':(1,-1,2),'vertical':(1,-1,4)},
+                {'horizontal_x':(3,None,5),'vertical':(None,None,3)},
+                {'channel':(1,2,1)}]
+
+        for roi in rois:
+            binner = Binner(roi, accelerated=False)
+            binner.set_input(data)
+
+            binned_arr_numba = numpy.empty(binner._shape_out,dtype=numpy.float32)
+            binned_arr_numpy = numpy.empty(binner._shape_out,dtype=numpy.float32)
+
+            binner._bin_array_numpy(data.array, binned_arr_numpy)
+            binner._bin_array_numba(data.array, binned_arr_numba)
+
+            numpy.testing.assert_allclose(binned_arr_numpy,binned_arr_numba,atol=1e-6)
+
+
+    def test_bin_accelerated_numba_fallback(self):
+
+        ig = ImageGeometry(64,32,16,channels=8)
+        data = ig.allocate('random')
+        roi = {'horizontal_x':(1,-1,16),'horizontal_y':(1,-1,8),'channel':(1,-1,2),'vertical':(1,-1,4)}
+
+        binned_numpy = Binner(roi, accelerated=False)(data)
+
+        # without IPP in the library the accelerated Binner uses the numba kernel
+        binner_module = sys.modules[Binner.__module__]
+        with mock.patch.object(binner_module, 'has_ipp', False), \
+            mock.patch.object(binner_module, '_bin_array_4D', wraps=binner_module._bin_array_4D) as kernel:
+            binned = Binner(roi, accelerated=True)(data)
+            kernel.assert_called_once()
+
+        self.assertEqual(binned.geometry, binned_numpy.geometry)
+        numpy.testing.assert_allclose(binned.array, binned_numpy.array, atol=1e-6)
+
+
+    def test_bin_numpy_backend(self):
+
+        ig = ImageGeometry(8,6,4,channels=3)
+        data = ig.allocate('random')
+        arr = data.array
+
+        roi = {'horizontal_x':(None,None,2),'vertical':(None,None,2)}
+        binned = Binner(roi, accelerated=False)(data)
+
+        gold = (arr[:,0::2,:,0::2] + arr[:,1::2,:,0::2] + arr[:,0::2,:,1::2] + arr[:,1::2,:,1::2]) / 4
+        numpy.testing.assert_allclose(binned.array, gold, atol=1e-6)
+
+        # offset roi with the binned channel squeezed out of the output
+        roi = {'channel':(1,None,2),'horizontal_y':(1,None,2)}
+        binned = Binner(roi, accelerated=False)(data)
+
+        gold = (arr[1,:,1:5:2,:] + arr[2,:,1:5:2,:] + arr[1,:,2:6:2,:] + arr[2,:,2:6:2,:]) / 4
+        self.assertEqual(binned.shape, gold.shape)
+        numpy.testing.assert_allclose(binned.array, gold, atol=1e-6)
+
+
     def test_bin_image_data(self):
         """
         Binning results tested with test_binning_cpp_ so this is checking wrappers with axis labels and geometry
@@ -443,6 +511,8 @@ class TestBinner(unittest.TestCase):
 
         binned_by_hand = ig_out.allocate(None)
 
+        arr = data.array
+        arr_by_hand = binned_by_hand.array
         l_out = 0
         for l in channel:
             k_out = 0
@@ -451,7 +521,7 @@ class TestBinner(unittest.TestCase):
                 for j in horizontal_y:
                     i_out = 0
                     for i in horizontal_x:
-                        binned_by_hand.array[l_out,k_out,j_out,i_out]  = data.array[l:l+channel.step,k:k+vertical.step,j:j+horizontal_y.step,i:i+horizontal_x.step].mean()
+                        arr_by_hand[l_out,k_out,j_out,i_out]  = arr[l:l+channel.step,k:k+vertical.step,j:j+horizontal_y.step,i:i+horizontal_x.step].mean()
                         i_out +=1
                     j_out +=1
                 k_out +=1
@@ -489,6 +559,8 @@ class TestBinner(unittest.TestCase):
         ag_out = AcquisitionGeometry.create_Cone3D([0,-50,0],[0,50,0]).set_angles(numpy.linspace(22.5,360+22.5,4,endpoint=False)).set_panel([2,3],[0.2,0.4]).set_channels(5)
         binned_by_hand = ag_out.allocate(None)
 
+        arr = data.array
+        arr_by_hand = binned_by_hand.array
         l_out = 0
         for l in channel:
             k_out = 0
@@ -497,7 +569,7 @@ class TestBinner(unittest.TestCase):
                 for j in vertical:
                     i_out = 0
                     for i in horizontal:
-                        binned_by_hand.array[l_out,k_out,j_out,i_out]  = data.array[l:l+channel.step,k:k+vertical.step,j:j+vertical.step,i:i+horizontal.step].mean()
+                        arr_by_hand[l_out,k_out,j_out,i_out]  = arr[l:l+channel.step,k:k+vertical.step,j:j+vertical.step,i:i+horizontal.step].mean()
                         i_out +=1
                     j_out +=1
                 k_out +=1
@@ -1252,10 +1324,12 @@ class TestSlicer(unittest.TestCase):
 
 class TestCentreOfRotation_parallel(unittest.TestCase):
     
-    def setUp(self):
+    @classmethod
+    def setUpClass(cls):
+        # loaded once for the class, the correctors do not modify their input
         data_raw = dataexample.SYNCHROTRON_PARALLEL_BEAM_DATA.get()
-        self.data_DLS = data_raw.log()
-        self.data_DLS *= -1
+        # -log in a single pass
+        cls.data_DLS = TransmissionAbsorptionConverter()(data_raw)
 
     def test_CofR_xcorrelation(self):       
 
@@ -1297,6 +1371,31 @@ class TestCentreOfRotation_parallel(unittest.TestCase):
         self.assertAlmostEqual(6.33, ad_out.geometry.config.system.rotation_axis.position[0],places=2)              
 
 
+class TestCentreOfRotation_xcorrelation_simulated(unittest.TestCase):
+
+    def setUp(self):
+        # point-like objects projected at 0, 90 and 180 degrees around an axis offset by 6.3 pixels
+        n = 256
+        self.ag = AcquisitionGeometry.create_Parallel3D().set_panel([n, 4]).set_angles([0, 90, 180])
+        self.data = self.ag.allocate(0)
+
+        u = numpy.arange(n) - (n - 1) / 2
+        arr = self.data.as_array()
+        for r, w in [(20, 1.0), (-45, 0.6), (70, 0.3)]:
+            arr[0] += w * numpy.exp(-(u - (6.3 + r))**2 / 8)
+            arr[1] += w * numpy.exp(-(u - 6.3)**2 / 8)
+            arr[2] += w * numpy.exp(-(u - (6.3 - r))**2 / 8)
+
+    def test_CofR_xcorrelation(self):
+
+        for slice_index in ['centre', 2]:
+            corr = CentreOfRotationCorrector.xcorrelation(slice_index=slice_index, projection_index=0, ang_tol=0.1)
+            corr.set_input(self.data)
+            ad_out = corr.get_output()
+            self.assertAlmostEqual(6.3, ad_out.geometry.config.system.rotation_axis.position[0], places=2)
+            numpy.testing.assert_array_equal(ad_out.as_array(), self.data.as_array())
+
+
 class TestCentreOfRotation_conebeam(unittest.TestCase):
 
     def setUp(self):
@@ -1945,6 +2044,60 @@ class TestDataProcessor(unittest.TestCase):
         with self.assertRaises(ValueError):
             dc_out = ax.get_output()
 
+    def test_store_output_reuse(self):
+
+        dc_in = DataContainer(numpy.arange(10, dtype=numpy.float32), True)
+        ax = AX()
+        ax.scalar = 2
+        ax.store_output = True
+        ax.set_input(dc_in)
+
+        dc_out = ax.get_output()
+        stored = ax.output.as_array()
+
+        # recalculation refills the stored copy in place
+        ax.scalar = 3
+        dc_out2 = ax.get_output()
+        self.assertTrue(ax.output.as_array() is stored)
+        self.assertFalse(dc_out2.as_array() is stored)
+        numpy.testing.assert_array_equal(ax.output.as_array(), dc_in.as_array() * 3)
+        numpy.testing.assert_array_equal(dc_out.as_array(), dc_in.as_array() * 2)
+
+        # without recalculation the stored copy fills out
+        dc_out.fill(0)
+        ax.get_output(out=dc_out)
+        numpy.testing.assert_array_equal(dc_out.as_array(), dc_in.as_array() * 3)
+
+        # a different shape replaces the stored copy
+        dc_in2 = DataContainer(numpy.arange(5, dtype=numpy.float32), True)
+        ax.set_input(dc_in2)
+        numpy.testing.assert_array_equal(ax.get_output().as_array(), dc_in2.as_array() * 3)
+        numpy.testing.assert_array_equal(ax.output.as_array(), dc_in2.as_array() * 3)
+
+    def test_AX_dtype(self):
+
+        # float32 data is not upcast by a float64 scalar
+        dc_in = DataContainer(numpy.arange(10, dtype=numpy.float32), True)
+        ax = AX()
+        ax.scalar = numpy.float64(0.5)
+        ax.set_input(dc_in)
+
+        dc_out = ax.get_output()
+        self.assertEqual(dc_out.dtype, numpy.float32)
+        numpy.testing.assert_array_equal(dc_out.as_array(), dc_in.as_array() * 0.5)
+
+        dc_out.fill(0)
+        ax.get_output(out=dc_out)
+        numpy.testing.assert_array_equal(dc_out.as_array(), dc_in.as_array() * 0.5)
+
+        # integer data is still promoted by a floating point scalar
+        dc_in = DataContainer(numpy.arange(10), True)
+        ax.set_input(dc_in)
+        numpy.testing.assert_array_equal(ax.get_output().as_array(), numpy.arange(10) * 0.5)
+
+        with self.assertRaises(ValueError):
+            ax.get_output(out=DataContainer(numpy.zeros(5), True))
+
 
     def test_DataProcessorChaining(self):
         shape = (2,3,4,5)
@@ -2001,7 +2154,44 @@ class TestDataProcessor(unittest.TestCase):
         
         self.assertTrue(v.max() == 19)
         self.assertTrue(v.min() == -79)
-        
+
+        # by default the function is evaluated in python, reading the variables it uses when called
+        threshold = 20
+        def pyfunc(x):
+            return -x if x > threshold else x
+        clip.pyfunc = pyfunc
+        self.assertEqual(clip.get_output().as_array().sum(), sum(pyfunc(x) for x in arr.ravel()))
+        threshold = 70
+        clip.pyfunc = pyfunc
+        clip.set_input(c)
+        self.assertEqual(clip.get_output().as_array().sum(), sum(pyfunc(x) for x in arr.ravel()))
+
+        # and integer results are python ints which do not overflow
+        clip.pyfunc = lambda x: x**20
+        v = clip.get_output().as_array()
+        self.assertEqual(list(v.ravel()), [int(x)**20 for x in arr.ravel()])
+
+        # compiled with numba the output is numeric
+        clip = PixelByPixelDataProcessor(compile=True)
+        clip.pyfunc = lambda x: -x if x > 20 else x
+        clip.set_input(c)
+        v = clip.get_output().as_array()
+        self.assertTrue(v.max() == 19)
+        self.assertTrue(v.min() == -79)
+        if has_numba:
+            self.assertEqual(v.dtype, c.dtype)
+
+        # a function numba cannot compile is evaluated in python
+        clip.pyfunc = lambda x: len(str(x))
+        v = clip.get_output().as_array()
+        numpy.testing.assert_array_equal(v.ravel(), [len(str(x)) for x in c.as_array().ravel()])
+
+        # builtins, numpy ufuncs and functions numba only fails on when called are evaluated in python
+        for pyfunc in [abs, math.sqrt, numpy.exp, lambda x: x if x > 0 else None]:
+            clip.pyfunc = pyfunc
+            v = clip.get_output().as_array()
+            numpy.testing.assert_array_equal(v.ravel(), [pyfunc(x) for x in arr.ravel()])
+
         #print ("clip in {0} out {1}".format(c.as_array(), clip.get_output().as_array()))
         
         #dsp = DataProcessor()
@@ -2241,10 +2431,37 @@ class TestTransmissionAbsorptionConverter(unittest.TestCase):
         
         data_exp.fill(0)
         s.process(out=data_exp)
-        
+
         self.assertTrue(data_exp.geometry == AG)
         numpy.testing.assert_allclose(data_exp.as_array(), data_new, rtol=1E-6)
 
+        # in place
+        data_exp = ad.copy()
+        s.process(out=data_exp)
+        numpy.testing.assert_allclose(data_exp.as_array(), data_new, rtol=1E-6)
+
+        # default white_level and no threshold
+        ad += 0.1
+        s = TransmissionAbsorptionConverter()
+        s.set_input(ad)
+        data_exp = s.get_output()
+        numpy.testing.assert_allclose(data_exp.as_array(), -1 * numpy.log(ad.as_array()), rtol=1E-6)
+
+        # DataContainer without a geometry
+        dc = DataContainer(ad.as_array(), dimension_labels=ad.dimension_labels)
+        s.set_input(dc)
+        data_exp = s.get_output()
+        self.assertEqual(data_exp.dimension_labels, dc.dimension_labels)
+        numpy.testing.assert_allclose(data_exp.as_array(), -1 * numpy.log(ad.as_array()), rtol=1E-6)
+
+        # integer counts
+        dc = DataContainer(numpy.array([[10, 20, 30], [1, 2, 3]], dtype=numpy.uint16), dimension_labels=['vertical', 'horizontal'])
+        s = TransmissionAbsorptionConverter(white_level=30)
+        s.set_input(dc)
+        data_exp = s.get_output()
+        self.assertEqual(data_exp.dtype, numpy.float32)
+        numpy.testing.assert_allclose(data_exp.as_array(), -1 * numpy.log(dc.as_array() / 30), rtol=1E-6)
+
 class TestAbsorptionTransmissionConverter(unittest.TestCase):
 
     def test_AbsorptionTransmissionConverter(self):
@@ -2275,18 +2492,58 @@ class TestAbsorptionTransmissionConverter(unittest.TestCase):
         
         ad = AG.allocate('random')
         
+        # references, evaluated once in a single buffer
+        data_new = numpy.negative(ad.as_array())
+        numpy.exp(data_new, out=data_new)
+        data_new_wl = data_new * 10
+
         s = AbsorptionTransmissionConverter(white_level=10)
         s.set_input(ad)
         data_exp = s.get_output()
         
         self.assertTrue(data_exp.geometry == AG)
-        numpy.testing.assert_allclose(data_exp.as_array(), numpy.exp(-ad.as_array())*10, rtol=1E-6)
+        numpy.testing.assert_allclose(data_exp.as_array(), data_new_wl, rtol=1E-6)
         
         data_exp.fill(0)
         s.process(out=data_exp)
         
         self.assertTrue(data_exp.geometry == AG)
-        numpy.testing.assert_allclose(data_exp.as_array(), numpy.exp(-ad.as_array())*10, rtol=1E-6)  
+        numpy.testing.assert_allclose(data_exp.as_array(), data_new_wl, rtol=1E-6)  
+
+        # in place
+        data_exp = ad.copy()
+        s.process(out=data_exp)
+        numpy.testing.assert_allclose(data_exp.as_array(), data_new_wl, rtol=1E-6)
+
+        s = AbsorptionTransmissionConverter()
+        s.set_input(ad)
+        data_exp = s.get_output()
+
+        numpy.testing.assert_allclose(data_exp.as_array(), data_new, rtol=1E-6)
+
+        dc = DataContainer(ad.as_array(), dimension_labels=ad.dimension_labels)
+        s.set_input(dc)
+        data_exp = s.get_output()
+
+        self.assertEqual(data_exp.dimension_labels, dc.dimension_labels)
+        numpy.testing.assert_allclose(data_exp.as_array(), data_new, rtol=1E-6)
+
+        dc = DataContainer(ad.as_array().astype(numpy.float64), dimension_labels=ad.dimension_labels)
+        s = AbsorptionTransmissionConverter(white_level=10, dtype=numpy.float32)
+        s.set_input(dc)
+        data_exp = s.get_output()
+
+        self.assertEqual(data_exp.dtype, numpy.float32)
+        numpy.testing.assert_allclose(data_exp.as_array(), data_new_wl, rtol=1E-6)
+
+        # integer input gives a floating point output by default
+        dc = DataContainer(numpy.arange(6, dtype=numpy.int32).reshape(2,3), dimension_labels=['vertical', 'horizontal'])
+        s = AbsorptionTransmissionConverter()
+        s.set_input(dc)
+        data_exp = s.get_output()
+
+        self.assertTrue(numpy.issubdtype(data_exp.dtype, numpy.floating))
+        numpy.testing.assert_allclose(data_exp.as_array(), numpy.exp(-dc.as_array()), rtol=1E-6)
 
 
 class TestMasker(unittest.TestCase):       
@@ -18,8 +18,9 @@
 # CIL Developers, listed at: https://github.com/TomographicImaging/CIL/blob/master/NOTICE.txt
 
 import unittest
+from unittest import mock
 from cil.optimisation.functions import KullbackLeibler
-from cil.framework import ImageGeometry
+from cil.framework import ImageGeometry, ImageData
 import numpy
 import scipy
 from utils import has_numba, initialise_tests
@@ -53,6 +54,9 @@ class TestKullbackLeiblerNumpy(unittest.TestCase):
         with self.assertRaises(ValueError):        
             f = KullbackLeibler(b=-1*self.g1)
 
+        with self.assertRaises(ValueError):
+            f = KullbackLeibler(b=self.g1, backend='cupy')
+
     def test_call_method(self):
 
         # without eta      
@@ -64,6 +68,13 @@ class TestKullbackLeiblerNumpy(unittest.TestCase):
         tmp = scipy.special.kl_div(self.f1.b.as_array()[ind], tmp_sum[ind])                 
         numpy.testing.assert_allclose(self.f1(self.u1), numpy.sum(tmp) )          
 
+        # with x + eta < 0 on some pixels
+        u2 = self.u1 - 0.5
+        tmp_sum = (u2 + self.f1.eta).as_array()
+        ind = tmp_sum >= 0
+        tmp = scipy.special.kl_div(self.f1.b.as_array()[ind], tmp_sum[ind])
+        numpy.testing.assert_allclose(self.f1(u2), numpy.sum(tmp), rtol=1e-6)
+
     def test_gradient_method(self): 
 
         # without eta
@@ -78,6 +89,14 @@ class TestKullbackLeiblerNumpy(unittest.TestCase):
         self.f1.gradient(self.u1, out = res2) 
         numpy.testing.assert_allclose(res1.as_array(), res2.as_array())   
 
+        # with x + eta <= 0 on some pixels, which are left to x + eta
+        u2 = self.u1 - 1
+        res1 = self.f1.gradient(u2)
+        arr = (u2 + self.f1.eta).as_array()
+        ind = arr > 0
+        arr[ind] = 1 - self.f1.b.as_array()[ind]/arr[ind]
+        numpy.testing.assert_allclose(res1.as_array(), arr)
+
     def test_proximal_method(self):
 
         # without eta
@@ -92,6 +111,11 @@ class TestKullbackLeiblerNumpy(unittest.TestCase):
         self.f1.proximal(self.u1, self.tau, out = res2)
         numpy.testing.assert_array_almost_equal(res1.as_array(), res2.as_array(), decimal=4)          
 
+        # against the closed form
+        x, eta, tau = self.u1, self.f1.eta, self.tau
+        res3 = 0.5 * ((x - eta - tau) + ((x + eta - tau).power(2) + 4 * tau * self.f1.b).sqrt())
+        numpy.testing.assert_array_almost_equal(res1.as_array(), res3.as_array(), decimal=4)
+
     def test_proximal_conjugate_method(self):
 
         # without eta
@@ -106,6 +130,55 @@ class TestKullbackLeiblerNumpy(unittest.TestCase):
         self.f1.proximal_conjugate(self.u1, self.tau, out = res2)
         numpy.testing.assert_array_almost_equal(res1.as_array(), res2.as_array(), decimal=4)          
 
+        # against the closed form
+        z = self.u1 + self.tau * self.f1.eta
+        res3 = 0.5 * ((z + 1) - ((z - 1).power(2) + 4 * self.tau * self.f1.b).sqrt())
+        numpy.testing.assert_array_almost_equal(res1.as_array(), res3.as_array(), decimal=4)
+
+        # out can be the input
+        res4 = self.u1.copy()
+        self.f1.proximal_conjugate(res4, self.tau, out = res4)
+        numpy.testing.assert_array_almost_equal(res3.as_array(), res4.as_array(), decimal=4)
+
+    def test_proximal_conjugate_precision(self):
+
+        # tau * b close to z, the difference (z + 1) - sqrt(...) cancels in float32
+        x = self.ig.allocate(1000)
+        b = self.ig.allocate(1000.5)
+        tau = 1.
+        z = numpy.float64(1000)
+        expected = 0.5 * ((z + 1) - numpy.sqrt((z - 1)**2 + 4 * tau * 1000.5))
+
+        for backend in ['numpy', 'numba'] if has_numba else ['numpy']:
+            f = KullbackLeibler(b=b, backend=backend)
+            res = f.proximal_conjugate(x, tau)
+            numpy.testing.assert_allclose(res.as_array(), expected, rtol=1e-5)
+
+        # z << -1, the rationalised denominator (z + 1) + sqrt(...) cancels in float32
+        z = -numpy.logspace(0.1, 6, numpy.prod(self.ig.shape)).reshape(self.ig.shape)
+        x = self.ig.allocate(None)
+        x.fill(z)
+        z = x.as_array().astype(numpy.float64)
+        expected = 0.5 * ((z + 1) - numpy.sqrt((z - 1)**2 + 4 * tau * 1000.5))
+
+        for backend in ['numpy', 'numba'] if has_numba else ['numpy']:
+            f = KullbackLeibler(b=b, backend=backend)
+            res = f.proximal_conjugate(x, tau)
+            numpy.testing.assert_allclose(res.as_array(), expected, rtol=1e-5)
+
+        # 0 < z < 1 with tau * b close to z, z must not be rebuilt from z - 1
+        for xv, bv in [(0.05, 0.050001), (1e-3, 1.001e-3)]:
+            x = self.ig.allocate(xv)
+            b = self.ig.allocate(bv)
+            z = x.as_array().astype(numpy.float64)
+            tb = tau * b.as_array().astype(numpy.float64)
+            expected = 0.5 * ((z + 1) - numpy.sqrt((z - 1)**2 + 4 * tb))
+
+            for backend in ['numpy', 'numba'] if has_numba else ['numpy']:
+                f = KullbackLeibler(b=b, backend=backend)
+                res = f.proximal_conjugate(x, tau)
+                numpy.testing.assert_allclose(res.as_array(), expected, rtol=1e-5)
+
     def test_convex_conjugate_method(self):
 
         # with eta
@@ -124,6 +197,77 @@ class TestKullbackLeiblerNumpy(unittest.TestCase):
         res2 = self.f.convex_conjugate(self.u1)  
         numpy.testing.assert_equal(res1, res2)   
 
+        # with 1 - x <= 0 on some pixels
+        u2 = self.u1 + 0.5
+        tmp = 1 - u2.as_array()
+        ind = tmp>0
+        xlogy = - scipy.special.xlogy(self.f1.b.as_array()[ind], tmp[ind])
+        res1 = numpy.sum(xlogy) - self.f1.eta.dot(u2)
+        res2 = self.f1.convex_conjugate(u2)
+        numpy.testing.assert_allclose(res1, res2, rtol=1e-6)
+
+    def test_without_eta(self):
+
+        # eta = None takes a shortcut, compare with an explicit zero eta
+        f0 = KullbackLeibler(b = self.g1, eta = self.ig.allocate(0), backend='numpy')
+        x = self.u1 - 0.3
+
+        numpy.testing.assert_allclose(self.f(x), f0(x), rtol=1e-6)
+        numpy.testing.assert_allclose(self.f.convex_conjugate(x), f0.convex_conjugate(x), rtol=1e-6)
+        numpy.testing.assert_allclose(self.f.gradient(x).as_array(), f0.gradient(x).as_array(), rtol=1e-6)
+        numpy.testing.assert_allclose(self.f.proximal(x, self.tau).as_array(),
+                                      f0.proximal(x, self.tau).as_array(), rtol=1e-5)
+        numpy.testing.assert_allclose(self.f.proximal_conjugate(x, self.tau).as_array(),
+                                      f0.proximal_conjugate(x, self.tau).as_array(), rtol=1e-5)
+
+    def test_allocate_output(self):
+
+        # the returned containers follow the input, not the geometry default dtype
+        x = self.ig.allocate(None, dtype=numpy.float64)
+        x.fill(self.u1.as_array().astype(numpy.float64))
+
+        for res in [self.f1.proximal(x, self.tau), self.f1.proximal_conjugate(x, self.tau)]:
+            self.assertEqual(res.dtype, numpy.float64)
+            self.assertEqual(res.geometry, x.geometry)
+
+        numpy.testing.assert_allclose(self.f1.proximal(x, self.tau).as_array(),
+                                      self.f1.proximal(self.u1, self.tau).as_array(), atol=1e-4)
+
+    def test_batch_call(self):
+
+        x = numpy.stack([self.u1.as_array(), self.u1.as_array() - 0.5, self.g1.as_array()])
+        b = numpy.stack([self.g1.as_array()] * 3)
+        eta = numpy.stack([self.b1.as_array()] * 3)
+
+        res = KullbackLeibler.batch_call(b, x, eta)
+        self.assertEqual(res.shape, (3,))
+        for i in range(3):
+            xi = self.ig.allocate(None)
+            xi.fill(x[i])
+            numpy.testing.assert_allclose(res[i], self.f1(xi), rtol=1e-6)
+
+        res = KullbackLeibler.batch_call(b, x)
+        xi = self.ig.allocate(None)
+        xi.fill(x[0])
+        numpy.testing.assert_allclose(res[0], self.f(xi), rtol=1e-6)
+
+    def test_as_array_copy(self):
+
+        # containers like SIRF's return a copy from as_array, the results must be filled back
+        def sapyb(self, a, y, b, out=None, num_threads=None):
+            a = a.as_array() if hasattr(a, 'as_array') else a
+            b = b.as_array() if hasattr(b, 'as_array') else b
+            out.array[:] = a * self.as_array() + b * y.as_array()
+
+        for backend in ['numpy', 'numba'] if has_numba else ['numpy']:
+            f = KullbackLeibler(b=self.g1, eta=self.b1, backend=backend)
+            expected = [f.gradient(self.u1), f.proximal(self.u1, self.tau), f.proximal_conjugate(self.u1, self.tau)]
+            with mock.patch.object(ImageData, 'as_array', lambda self: self.array.copy()), \
+                 mock.patch.object(ImageData, 'sapyb', sapyb):
+                res = [f.gradient(self.u1), f.proximal(self.u1, self.tau), f.proximal_conjugate(self.u1, self.tau)]
+            for r, e in zip(res, expected):
+                numpy.testing.assert_allclose(r.array, e.array, rtol=1e-5)
+
 class TestKullbackLeiblerNumba(unittest.TestCase):
 
     def setUp(self):
@@ -182,6 +326,15 @@ class TestKullbackLeiblerNumba(unittest.TestCase):
         numpy.testing.assert_allclose(f(u1), f_np(u1),  rtol=1e-5)
 
 
+    @unittest.skipUnless(has_numba, "Skipping because numba isn't installed")
+    def test_KullbackLeibler_numba_call_infeasible(self):
+        f = self.f
+        u1 = self.u1 * -1
+
+        numpy.testing.assert_equal(f(u1), numpy.inf)
+        numpy.testing.assert_equal(self.f_mask(u1), numpy.inf)
+
+
     @unittest.skipUnless(has_numba, "Skipping because numba isn't installed")
     def test_KullbackLeibler_numba_call_mask(self):
         f = self.f
@@ -237,6 +390,26 @@ class TestKullbackLeiblerNumba(unittest.TestCase):
         numpy.testing.assert_allclose(f.gradient(u1).as_array(), f_np.gradient(u1).as_array(), rtol=1e-3)
 
 
+    @unittest.skipUnless(has_numba, "Skipping because numba isn't installed")
+    def test_KullbackLeibler_numba_gradient_mask(self):
+        f = self.f
+        u1 = self.u1
+
+        numpy.testing.assert_allclose(f.gradient(u1).as_array(),
+            (self.f_mask.gradient(u1) + self.f_mask_c.gradient(u1)).as_array(), rtol=1e-5)
+
+
+    @unittest.skipUnless(has_numba, "Skipping because numba isn't installed")
+    def test_KullbackLeibler_numba_proximal_arr_mask(self):
+        f = self.f
+        tau = self.u1.copy()
+        tau.fill(self.tau)
+        u1 = self.u1
+
+        numpy.testing.assert_allclose(f.proximal(u1, tau=tau).as_array(),
+            (self.f_mask.proximal(u1, tau=tau) + self.f_mask_c.proximal(u1, tau=tau)).as_array(), rtol=1e-5)
+
+
     @unittest.skipUnless(has_numba, "Skipping because numba isn't installed")
     def test_KullbackLeibler_numba_convex_conjugate(self):
         f = self.f